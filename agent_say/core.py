@@ -0,0 +1,228 @@
+"""Engine-independent helpers shared by the MCP server (main.py) and speak_cli.py."""
+import functools
+import math
+import os
+import re
+import shutil
+import time
+from pathlib import Path
+from typing import Optional
+
+# Repository root: holds swift_tts.swift and the fallback tmp/ directory.
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+# Adaptive timeout parameters
+DEFAULT_CHARS_PER_SEC = 6.0  # fallback speech rate
+CJK_SLOWDOWN_FACTOR = 1.35  # slow down estimate for Japanese/Chinese/Korean text
+MIN_TIMEOUT = 5.0
+AUTO_CAP_SECONDS = 300.0  # prefer full read: floor to 300s unless explicitly overridden
+DEFAULT_TIMEOUT_SECONDS = 20.0
+BUFFER_SECONDS = 2.0
+CPS_FRAC_BITS = 16  # engine_stats is stored as Q16.16 fixed point
+CPS_AVG_SHIFT = 3  # mean EWMA gain 1/2**shift, i.e. 1/8 (TCP SRTT style)
+CPS_DEV_SHIFT = 2  # mean-deviation EWMA gain 1/4 (TCP RTTVAR style)
+CPS_HALF_TIME = 300.0  # seconds after which an old observation's weight has halved
+CPS_TAU = CPS_HALF_TIME / math.log(2)
+CPS_DEV_MULTIPLIER = 2.0  # timeout assumes speech may run this many deviations slow
+CPS_MIN_RATE_FRACTION = 0.5  # ...but never budgets for less than this share of the mean
+
+# Speed control
+DEFAULT_WPM = 175  # baseline for say/espeak
+MIN_SPEED = 0.25
+MAX_SPEED = 4.0
+
+# Keep a simple in-memory per-engine rolling (mean, mean deviation, last update) of
+# speed; mean/deviation are fixed point, see get_cps_stats
+engine_stats: dict[str, tuple[int, int, float]] = {}
+
+_TMPDIR_READY: Optional[Path] = None  # set once ensure_tmpdir has run
+_SWIFT_PATH = ROOT_DIR / "swift_tts.swift"
+
+# Precompiled patterns for the per-call text helpers. strip_markdown applies the
+# inline patterns one after another, in this order: later passes see the output of
+# earlier ones (e.g. `snake_case` spans lose their underscores before the code pass).
+_MD_BOLD = re.compile(r"(\*\*|__)(.*?)\1")
+_MD_ITALIC = re.compile(r"(\*|_)(.*?)\1")
+_MD_LINK = re.compile(r"\[([^\]]+)\]\([^\)]+\)")
+_MD_CODE = re.compile(r"`([^`]+)`")
+# Blockquote marker, then any header marker it exposes, in one pass.
+_MD_LINE = re.compile(r"^(?:>\s?(?:#+\s?)?|#+\s?)", re.MULTILINE)
+_MD_PROBE = re.compile(r"[*_\[`>#]")  # any char one of the patterns above needs
+_CJK_RE = re.compile(r"[\u3040-\u30ff\u4e00-\u9fff]")
+
+
+def strip_markdown(text: str) -> str:
+    """Remove common markdown syntax for cleaner speech."""
+    if not _MD_PROBE.search(text):
+        return text.strip()
+    # Passes only ever remove characters, so a pass whose delimiter is absent
+    # from the current text cannot match and is skipped.
+    if "**" in text or "__" in text:
+        text = _MD_BOLD.sub(r"\2", text)
+    if "*" in text or "_" in text:
+        text = _MD_ITALIC.sub(r"\2", text)
+    if "](" in text:
+        text = _MD_LINK.sub(r"\1", text)
+    if "`" in text:
+        text = _MD_CODE.sub(r"\1", text)
+    if ">" in text or "#" in text:
+        text = _MD_LINE.sub("", text)
+    return text.strip()
+
+
+def ensure_tmpdir() -> Path:
+    """Ensure TMPDIR points to a workspace-writeable path."""
+    global _TMPDIR_READY
+    if _TMPDIR_READY is not None:
+        return _TMPDIR_READY
+
+    current = os.environ.get("TMPDIR")
+    if current:
+        path = Path(current)
+        if path.is_dir() and os.access(path, os.W_OK):
+            tmpdir = path
+        else:
+            tmpdir = None
+    else:
+        tmpdir = None
+
+    if tmpdir is None:
+        tmpdir = ROOT_DIR / "tmp"
+        tmpdir.mkdir(parents=True, exist_ok=True)
+        os.environ["TMPDIR"] = str(tmpdir)
+
+    # Swift (and its clang integration) may try to write module caches under ~/.cache.
+    # Force a workspace-writable cache path when needed.
+    clang_cache = os.environ.get("CLANG_MODULE_CACHE_PATH")
+    if clang_cache:
+        cache_path = Path(clang_cache)
+        if not (cache_path.is_dir() and os.access(cache_path, os.W_OK)):
+            cache_path = tmpdir / "clang-module-cache"
+            cache_path.mkdir(parents=True, exist_ok=True)
+            os.environ["CLANG_MODULE_CACHE_PATH"] = str(cache_path)
+    else:
+        cache_path = tmpdir / "clang-module-cache"
+        cache_path.mkdir(parents=True, exist_ok=True)
+        os.environ["CLANG_MODULE_CACHE_PATH"] = str(cache_path)
+
+    _TMPDIR_READY = tmpdir
+    return tmpdir
+
+
+def get_cps_stats(engine_name: Optional[str]) -> tuple[float, float]:
+    """Return (mean, mean deviation) of chars/sec for the engine."""
+    key = engine_name or "auto"
+    stats = engine_stats.get(key)
+    if stats is None:
+        return DEFAULT_CHARS_PER_SEC, 0.0
+    scale = 1 << CPS_FRAC_BITS
+    return stats[0] / scale, stats[1] / scale
+
+
+def get_cps(engine_name: Optional[str]) -> float:
+    """Return current chars/sec estimate for the engine."""
+    return get_cps_stats(engine_name)[0]
+
+
+def update_cps(engine_name: Optional[str], measured_cps: float) -> None:
+    """Update moving mean/deviation of chars/sec for the engine (normalized to speed=1.0)."""
+    if measured_cps <= 0:
+        return
+    if not math.isfinite(measured_cps):
+        return
+    key = engine_name or "auto"
+    now = time.monotonic()
+    sample = int(round(measured_cps * (1 << CPS_FRAC_BITS)))
+    stats = engine_stats.get(key)
+    if stats is None:
+        engine_stats[key] = (sample, 0, now)
+        return
+    avg, dev, last_ts = stats
+    # Shift-based EWMAs (as in Linux lib/average.c) whose history additionally decays
+    # with the time since the last update: the old value keeps (1 - gain) * exp(-age/tau)
+    # of the weight, so back-to-back samples use the plain gains and history from
+    # long-idle engines is forgotten. decay is exp(-age/tau) in Q16.
+    decay = int(math.exp(-max(now - last_ts, 0.0) / CPS_TAU) * (1 << CPS_FRAC_BITS))
+    # The deviation is measured against the mean *before* this sample, like TCP RTTVAR.
+    err = abs(sample - avg)
+    held = ((avg - sample) * decay) >> CPS_FRAC_BITS
+    avg = sample + held - (held >> CPS_AVG_SHIFT)
+    held = ((dev - err) * decay) >> CPS_FRAC_BITS
+    dev = err + held - (held >> CPS_DEV_SHIFT)
+    engine_stats[key] = (avg, dev, now)
+
+
+def estimate_timeout(text: str, base_timeout: float, engine_name: Optional[str], speed: float) -> float:
+    """Estimate timeout from text length and engine speed."""
+    # Slow down estimate for CJK text because TTS expands kanji to syllables.
+    # str.isascii() is O(1) on CPython (stored flag), so ASCII replies never hit the regex.
+    factor = CJK_SLOWDOWN_FACTOR if not text.isascii() and _CJK_RE.search(text) else 1.0
+    # Budget for a pessimistic rate so one volatile engine does not get cut off early.
+    avg, dev = get_cps_stats(engine_name)
+    cps = max(avg - CPS_DEV_MULTIPLIER * dev, avg * CPS_MIN_RATE_FRACTION) * max(speed, 1e-3)
+    est = len(text) * factor / max(cps, 1e-3) + BUFFER_SECONDS
+    est = max(est, base_timeout, MIN_TIMEOUT)
+
+    # Respect explicit timeout requests as-is (other than the above minimum floor).
+    if base_timeout != DEFAULT_TIMEOUT_SECONDS:
+        return est
+
+    # Auto mode: prefer finishing the read even if slow, floor to 300s, but allow
+    # even longer runs when the estimate exceeds that.
+    if est >= AUTO_CAP_SECONDS:
+        return est
+    return AUTO_CAP_SECONDS
+
+
+@functools.lru_cache(maxsize=16)
+def _resolve_command(engine: Optional[str], path_env: str) -> Optional[tuple[str, ...]]:
+    # path_env is only part of the cache key: a PATH change must re-run the lookups.
+    # Absolute paths are returned on purpose: subprocess only takes its posix_spawn
+    # fast path when the executable has a directory component.
+    if engine in (None, "", "auto", "say"):
+        say = shutil.which("say")
+        if say:
+            return (say,)
+        if engine not in (None, "", "auto"):
+            return None
+    if engine in (None, "", "auto", "swift"):
+        if _SWIFT_PATH.exists():
+            return (str(_SWIFT_PATH),)
+        if engine == "swift":
+            return None
+    if engine in (None, "", "auto", "espeak"):
+        espeak = shutil.which("espeak")
+        if espeak:
+            return (espeak,)
+    return None
+
+
+def pick_command(engine: Optional[str]) -> Optional[list[str]]:
+    resolved = _resolve_command(engine, os.environ.get("PATH", ""))
+    return list(resolved) if resolved is not None else None
+
+
+def speed_to_wpm(speed: float) -> int:
+    """Convert a speed multiplier to words per minute for say/espeak."""
+    wpm = int(round(DEFAULT_WPM * speed))
+    # Conservative clamps to avoid extreme values.
+    return max(80, min(600, wpm))
+
+
+@functools.lru_cache(maxsize=64)
+def _speed_args(engine_name: str, speed: float) -> tuple[str, ...]:
+    # Callers use a handful of distinct speeds, so this is nearly always a cache hit.
+    if engine_name == "say":
+        return ("-r", str(speed_to_wpm(speed)))
+    if engine_name == "espeak":
+        return ("-s", str(speed_to_wpm(speed)))
+    if engine_name == "swift_tts.swift":
+        return ("--speed", f"{speed:g}")
+    return ()
+
+
+def with_speed_args(cmd: list[str], engine_name: str, speed: float) -> list[str]:
+    if speed == 1.0:
+        return cmd
+    args = _speed_args(engine_name, speed)
+    return [*cmd, *args] if args else cmd
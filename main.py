@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 import asyncio
+import atexit
 import hashlib
+import json
 import logging
 import math
 import os
 import re
-import shutil
 import sys
 import time
+from collections import OrderedDict
 from pathlib import Path
 from typing import Literal, Optional
 
@@ -32,56 +34,79 @@ except ModuleNotFoundError as e:
         raise SystemExit(1)
     raise
 
+from agent_say.core import (
+    DEFAULT_TIMEOUT_SECONDS,
+    MAX_SPEED,
+    MIN_SPEED,
+    engine_stats,
+    ensure_tmpdir,
+    estimate_timeout,
+    pick_command,
+    strip_markdown,
+    update_cps,
+    with_speed_args,
+)
+
 # Avoid stdout logging; MCP uses stdout for JSON-RPC
 logging.basicConfig(level=logging.INFO, stream=sys.stderr, format="%(levelname)s %(message)s")
 
 mcp = FastMCP("agent-say")
 
-# Adaptive timeout parameters
-DEFAULT_CHARS_PER_SEC = 6.0  # fallback speech rate
-CJK_SLOWDOWN_FACTOR = 1.35  # slow down estimate for Japanese/Chinese/Korean text
-MIN_TIMEOUT = 5.0
-AUTO_CAP_SECONDS = 300.0  # prefer full read: floor to 300s unless explicitly overridden
-DEFAULT_TIMEOUT_SECONDS = 20.0
+# Speech guards (speech-rate and timeout parameters live in agent_say.core)
 HARD_TIMEOUT_SECONDS = 600.0  # hard upper bound to avoid stuck speech processes
-BUFFER_SECONDS = 2.0
-SMOOTHING = 0.2  # exponential moving average factor
 MAX_CONCURRENT_SPEECH = 2
 DEFAULT_DEDUPE_SECONDS = 30.0
 
-# Speed control
-DEFAULT_WPM = 175  # baseline for say/espeak
-MIN_SPEED = 0.25
-MAX_SPEED = 4.0
-
-# Keep a simple in-memory per-engine rolling average of speed
-engine_cps: dict[str, float] = {}
+# Persisted speech-rate stats (survive server restarts)
+STATS_FILENAME = "engine_stats.json"
+STATS_FLUSH_SECONDS = 30.0  # debounce interval for writes after an update
+STATS_MAX_AGE_SECONDS = 30 * 24 * 3600.0  # drop engines not updated for 30 days
 
 # Best-effort in-memory guards / bookkeeping
-speech_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SPEECH)
+# Concurrency gate: a counter guarded by a condition so the limit can be resized at runtime.
+speech_cond = asyncio.Condition()
+speech_active = 0
+speech_limit = MAX_CONCURRENT_SPEECH
 in_flight: set[str] = set()
-recent_requests: dict[str, float] = {}
+recent_requests: OrderedDict[str, float] = OrderedDict()  # oldest first
 background_tasks: set[asyncio.Task[str]] = set()
 active_procs: dict[str, asyncio.subprocess.Process] = {}
 
+_stats_path: Optional[Path] = None  # set once load_engine_stats has run
+_stats_dirty = False
+_stats_flush_task: Optional[asyncio.Task[None]] = None
+
+_NORM_WS = re.compile(r"\s+")
+
 
 def request_key(engine_name: str, text: str, speed: float) -> str:
-    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+    # Normalize only for the key so whitespace/case variants of a reply dedupe together.
+    norm = _NORM_WS.sub(" ", text).strip().lower()
+    digest = hashlib.blake2b(norm.encode("utf-8"), digest_size=8).hexdigest()
     speed_tag = f"{speed:.3f}"
     return f"{engine_name}:{speed_tag}:{digest}"
 
 
+def touch_recent_request(key: str, ts: float) -> None:
+    # Re-insert at the tail so recent_requests stays ordered by timestamp.
+    recent_requests.pop(key, None)
+    recent_requests[key] = ts
+
+
 def prune_recent_requests(now: float, keep_seconds: float) -> None:
     if keep_seconds <= 0:
         recent_requests.clear()
         return
     cutoff = now - keep_seconds
-    for key, ts in list(recent_requests.items()):
-        if ts < cutoff:
-            recent_requests.pop(key, None)
+    # Timestamps come from time.monotonic(), so expired entries sit at the head.
+    while recent_requests:
+        ts = next(iter(recent_requests.values()))
+        if ts >= cutoff:
+            break
+        recent_requests.popitem(last=False)
 
 
-def format_status(
+def status_prefix(
     *,
     engine_name: str,
     mode: str,
@@ -89,26 +114,129 @@ def format_status(
     dedupe_seconds: float,
     hard_timeout_seconds: float,
     timeout_seconds: float,
-    timeout_used: Optional[float],
-    dynamic_timeout: Optional[float],
 ) -> str:
-    parts: list[str] = [
-        f"engine={engine_name}",
-        f"mode={mode}",
-        f"speed={speed:g}x",
-        f"hard_timeout={hard_timeout_seconds:g}s",
-        f"dedupe={dedupe_seconds:g}s",
-        f"concurrency={MAX_CONCURRENT_SPEECH}",
-    ]
+    """Build the per-call invariant part of the status suffix (closed by format_status)."""
     if mode == "sync":
-        parts.append(f"timeout_seconds={timeout_seconds:g}s")
-        if dynamic_timeout is not None:
-            parts.append(f"dynamic_timeout={dynamic_timeout:g}s")
-        if timeout_used is not None:
-            parts.append(f"timeout_used={timeout_used:g}s")
+        timeout_part = f"timeout_seconds={timeout_seconds:g}s"
     else:
-        parts.append(f"timeout_seconds={timeout_seconds:g}s(ignored)")
-    return "(" + ", ".join(parts) + ")"
+        timeout_part = f"timeout_seconds={timeout_seconds:g}s(ignored)"
+    return (
+        f"(engine={engine_name}, mode={mode}, speed={speed:g}x, "
+        f"hard_timeout={hard_timeout_seconds:g}s, dedupe={dedupe_seconds:g}s, "
+        f"concurrency={speech_limit}, {timeout_part}"
+    )
+
+
+def format_status(
+    prefix: str,
+    *,
+    timeout_used: Optional[float] = None,
+    dynamic_timeout: Optional[float] = None,
+) -> str:
+    if dynamic_timeout is not None:
+        prefix = f"{prefix}, dynamic_timeout={dynamic_timeout:g}s"
+    if timeout_used is not None:
+        prefix = f"{prefix}, timeout_used={timeout_used:g}s"
+    return prefix + ")"
+
+
+def load_engine_stats(tmpdir: Path) -> None:
+    """Load persisted speech-rate stats from tmpdir (once per process)."""
+    global _stats_path
+    if _stats_path is not None:
+        return
+    _stats_path = tmpdir / STATS_FILENAME
+    atexit.register(save_engine_stats)
+    try:
+        data = json.loads(_stats_path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logging.warning("Ignoring unreadable %s: %s", _stats_path, e)
+        return
+    if not isinstance(data, dict):
+        return
+    # Timestamps are stored as wall-clock time and mapped back onto time.monotonic().
+    wall_now = time.time()
+    mono_now = time.monotonic()
+    for key, entry in data.items():
+        try:
+            avg, dev, updated_at = int(entry["avg"]), int(entry["dev"]), float(entry["updated_at"])
+        except (TypeError, KeyError, ValueError, OverflowError):
+            continue
+        age = wall_now - updated_at
+        if avg <= 0 or dev < 0 or not math.isfinite(age) or age > STATS_MAX_AGE_SECONDS:
+            continue
+        engine_stats.setdefault(key, (avg, dev, mono_now - max(age, 0.0)))
+
+
+def save_engine_stats() -> None:
+    """Write speech-rate stats to disk if they changed since the last write."""
+    global _stats_dirty
+    if _stats_path is None or not _stats_dirty:
+        return
+    wall_now = time.time()
+    mono_now = time.monotonic()
+    data = {
+        key: {"avg": avg, "dev": dev, "updated_at": wall_now - (mono_now - last_ts)}
+        for key, (avg, dev, last_ts) in engine_stats.items()
+    }
+    tmp_path = _stats_path.with_suffix(".tmp")
+    try:
+        tmp_path.write_text(json.dumps(data), encoding="utf-8")
+        os.replace(tmp_path, _stats_path)
+    except OSError as e:
+        logging.warning("Failed to save %s: %s", _stats_path, e)
+        return
+    _stats_dirty = False
+
+
+def mark_engine_stats_dirty() -> None:
+    """Flag stats as changed and schedule a debounced write when a loop is running."""
+    global _stats_dirty, _stats_flush_task
+    _stats_dirty = True
+    if _stats_path is None:
+        return
+    if _stats_flush_task is not None and not _stats_flush_task.done():
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return  # no running loop; atexit still flushes
+    _stats_flush_task = loop.create_task(_flush_engine_stats_later())
+
+
+async def _flush_engine_stats_later() -> None:
+    await asyncio.sleep(STATS_FLUSH_SECONDS)
+    save_engine_stats()
+
+
+async def acquire_speech_slot() -> None:
+    global speech_active
+    async with speech_cond:
+        while speech_active >= speech_limit:
+            await speech_cond.wait()
+        speech_active += 1
+
+
+async def try_acquire_speech_slot() -> bool:
+    """Take a slot only if one is free right now."""
+    global speech_active
+    async with speech_cond:
+        if speech_active >= speech_limit:
+            return False
+        speech_active += 1
+        return True
+
+
+async def release_speech_slot() -> None:
+    global speech_active
+    async with speech_cond:
+        if speech_active <= 0:
+            logging.error("Speech slot released more often than acquired; ignoring")
+            return
+        speech_active -= 1
+        speech_cond.notify(1)
 
 
 async def stop_process(proc: asyncio.subprocess.Process, timeout: float = 2.0) -> None:
@@ -135,14 +263,16 @@ async def run_speech_process(
     Returns (code, duration_seconds, err_message).
     code: 0 ok, -1 timed out, -2 not found, -3 not executable, else engine return code.
     """
-    env = os.environ.copy()
+    # The child inherits os.environ (including TMPDIR set by ensure_tmpdir) directly.
     try:
         proc = await asyncio.create_subprocess_exec(
             *cmd,
             text,
-            stdout=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,  # engine output is never used
             stderr=asyncio.subprocess.PIPE,
-            env=env,
+            # Our own fds are non-inheritable (PEP 446); skipping close_fds keeps the
+            # launch eligible for posix_spawn instead of fork+exec on macOS.
+            close_fds=False,
         )
     except FileNotFoundError:
         return -2, 0.0, "command not found"
@@ -162,126 +292,13 @@ async def run_speech_process(
         except asyncio.TimeoutError:
             await stop_process(proc)
             return -1, time.monotonic() - start, f"timeout after {effective_timeout} seconds"
-        return proc.returncode, time.monotonic() - start, stderr.decode()
+        if proc.returncode == 0:
+            return 0, time.monotonic() - start, ""
+        return proc.returncode, time.monotonic() - start, stderr.decode(errors="replace")
     finally:
         active_procs.pop(key, None)
 
 
-def strip_markdown(text: str) -> str:
-    """Remove common markdown syntax for cleaner speech."""
-    text = re.sub(r"(\*\*|__)(.*?)\1", r"\2", text)
-    text = re.sub(r"(\*|_)(.*?)\1", r"\2", text)
-    text = re.sub(r"\[([^\]]+)\]\([^\)]+\)", r"\1", text)
-    text = re.sub(r"`([^`]+)`", r"\1", text)
-    text = re.sub(r"^>\s?", "", text, flags=re.MULTILINE)
-    text = re.sub(r"^#+\s?", "", text, flags=re.MULTILINE)
-    return text.strip()
-
-
-def ensure_tmpdir() -> Path:
-    """Ensure TMPDIR points to a workspace-writeable path."""
-    current = os.environ.get("TMPDIR")
-    if current:
-        path = Path(current)
-        if path.is_dir() and os.access(path, os.W_OK):
-            tmpdir = path
-        else:
-            tmpdir = None
-    else:
-        tmpdir = None
-
-    if tmpdir is None:
-        tmpdir = Path(__file__).resolve().parent / "tmp"
-        tmpdir.mkdir(parents=True, exist_ok=True)
-        os.environ["TMPDIR"] = str(tmpdir)
-
-    # Swift (and its clang integration) may try to write module caches under ~/.cache.
-    # Force a workspace-writable cache path when needed.
-    clang_cache = os.environ.get("CLANG_MODULE_CACHE_PATH")
-    if clang_cache:
-        cache_path = Path(clang_cache)
-        if not (cache_path.is_dir() and os.access(cache_path, os.W_OK)):
-            cache_path = tmpdir / "clang-module-cache"
-            cache_path.mkdir(parents=True, exist_ok=True)
-            os.environ["CLANG_MODULE_CACHE_PATH"] = str(cache_path)
-    else:
-        cache_path = tmpdir / "clang-module-cache"
-        cache_path.mkdir(parents=True, exist_ok=True)
-        os.environ["CLANG_MODULE_CACHE_PATH"] = str(cache_path)
-
-    return tmpdir
-
-
-def get_cps(engine_name: Optional[str]) -> float:
-    """Return current chars/sec estimate for the engine."""
-    key = engine_name or "auto"
-    return engine_cps.get(key, DEFAULT_CHARS_PER_SEC)
-
-
-def update_cps(engine_name: Optional[str], measured_cps: float) -> None:
-    """Update exponential moving average of chars/sec for the engine (normalized to speed=1.0)."""
-    if measured_cps <= 0:
-        return
-    if not math.isfinite(measured_cps):
-        return
-    key = engine_name or "auto"
-    prev = engine_cps.get(key, DEFAULT_CHARS_PER_SEC)
-    engine_cps[key] = prev * (1 - SMOOTHING) + measured_cps * SMOOTHING
-
-
-def estimate_timeout(text: str, base_timeout: float, engine_name: Optional[str], speed: float) -> float:
-    """Estimate timeout from text length and engine speed."""
-    # Slow down estimate for CJK text because TTS expands kanji to syllables.
-    factor = CJK_SLOWDOWN_FACTOR if re.search(r"[\u3040-\u30ff\u4e00-\u9fff]", text) else 1.0
-    cps = get_cps(engine_name) * max(speed, 1e-3)
-    est = len(text) * factor / max(cps, 1e-3) + BUFFER_SECONDS
-    est = max(est, base_timeout, MIN_TIMEOUT)
-
-    # Respect explicit timeout requests as-is (other than the above minimum floor).
-    if base_timeout != DEFAULT_TIMEOUT_SECONDS:
-        return est
-
-    # Auto mode: prefer finishing the read even if slow, floor to 300s, but allow
-    # even longer runs when the estimate exceeds that.
-    if est >= AUTO_CAP_SECONDS:
-        return est
-    return AUTO_CAP_SECONDS
-
-
-def pick_command(engine: Optional[str]) -> Optional[list[str]]:
-    if engine in (None, "", "auto", "say"):
-        if shutil.which("say"):
-            return ["say"]
-        if engine not in (None, "", "auto"):
-            return None
-    if engine in (None, "", "auto", "swift"):
-        swift = Path(__file__).resolve().parent / "swift_tts.swift"
-        if swift.exists():
-            return [str(swift)]
-        if engine == "swift":
-            return None
-    if engine in (None, "", "auto", "espeak"):
-        if shutil.which("espeak"):
-            return ["espeak"]
-    return None
-
-
-def with_speed_args(cmd: list[str], engine_name: str, speed: float) -> list[str]:
-    if speed == 1.0:
-        return cmd
-    wpm = int(round(DEFAULT_WPM * speed))
-    # Conservative clamps to avoid extreme values.
-    wpm = max(80, min(600, wpm))
-
-    if engine_name == "say":
-        return cmd + ["-r", str(wpm)]
-    if engine_name == "espeak":
-        return cmd + ["-s", str(wpm)]
-    if engine_name == "swift_tts.swift":
-        return cmd + ["--speed", f"{speed:g}"]
-    return cmd
-
-
 @mcp.tool()
 async def speak(
     text: str,
@@ -294,7 +311,7 @@ async def speak(
     hard_timeout_seconds: float = HARD_TIMEOUT_SECONDS,
 ) -> str:
     """音声で読み上げます。engineはauto/say/swift/espeakから選択できます。"""
-    ensure_tmpdir()
+    load_engine_stats(ensure_tmpdir())
     clean_text = strip_markdown(text)
     if not clean_text:
         return "Text is empty."
@@ -308,17 +325,25 @@ async def speak(
     engine_name = Path(cmd[0]).name
     cmd = with_speed_args(cmd, engine_name, speed)
     mode = "sync" if wait_for_completion else "async"
+    status = status_prefix(
+        engine_name=engine_name,
+        mode=mode,
+        speed=speed,
+        dedupe_seconds=dedupe_seconds,
+        hard_timeout_seconds=hard_timeout_seconds,
+        timeout_seconds=timeout_seconds,
+    )
 
     now = time.monotonic()
     prune_recent_requests(now, max(dedupe_seconds * 2, 60.0) if dedupe_seconds > 0 else 0)
     key = request_key(engine_name, clean_text, speed)
     if dedupe_seconds > 0:
         if key in in_flight:
-            return f"Speech already running {format_status(engine_name=engine_name, mode=mode, speed=speed, dedupe_seconds=dedupe_seconds, hard_timeout_seconds=hard_timeout_seconds, timeout_seconds=timeout_seconds, timeout_used=None, dynamic_timeout=None)}"
+            return f"Speech already running {format_status(status)}"
         last = recent_requests.get(key)
         if last is not None and (now - last) < dedupe_seconds:
-            return f"Speech request deduped {format_status(engine_name=engine_name, mode=mode, speed=speed, dedupe_seconds=dedupe_seconds, hard_timeout_seconds=hard_timeout_seconds, timeout_seconds=timeout_seconds, timeout_used=None, dynamic_timeout=None)}"
-    recent_requests[key] = now
+            return f"Speech request deduped {format_status(status)}"
+    touch_recent_request(key, now)
 
     async def _run() -> str:
         in_flight.add(key)
@@ -360,40 +385,47 @@ async def speak(
             if code == 0 and duration > 0:
                 measured_cps = len(clean_text) / duration
                 update_cps(engine_name, measured_cps / max(speed, 1e-3))
+                mark_engine_stats_dirty()
             if code == -2:
                 return "Speech engine command not found."
             if code == -3:
                 return "Speech engine is not executable."
-            if code == 0:
-                return f"Spoken {format_status(engine_name=engine_name, mode=mode, speed=speed, dedupe_seconds=dedupe_seconds, hard_timeout_seconds=hard_timeout_seconds, timeout_seconds=timeout_seconds, timeout_used=timeout_used, dynamic_timeout=dynamic_timeout)}"
-            if code == -1:
+            if code in (0, -1):
+                # Adaptive timeout details are only meaningful in sync mode.
+                if wait_for_completion:
+                    done_status = format_status(status, timeout_used=timeout_used, dynamic_timeout=dynamic_timeout)
+                else:
+                    done_status = format_status(status)
+                if code == 0:
+                    return f"Spoken {done_status}"
                 timeout_label = timeout_used if timeout_used is not None else hard_timeout_seconds
-                return f"Speech timed out after {timeout_label:g}s {format_status(engine_name=engine_name, mode=mode, speed=speed, dedupe_seconds=dedupe_seconds, hard_timeout_seconds=hard_timeout_seconds, timeout_seconds=timeout_seconds, timeout_used=timeout_used, dynamic_timeout=dynamic_timeout)}"
+                return f"Speech timed out after {timeout_label:g}s {done_status}"
             return f"Speech failed with code {code}: {err.strip()}"
         finally:
             in_flight.discard(key)
-            recent_requests[key] = time.monotonic()
+            touch_recent_request(key, time.monotonic())
 
     if wait_for_completion:
-        async with speech_semaphore:
+        await acquire_speech_slot()
+        try:
             return await _run()
+        finally:
+            await release_speech_slot()
 
-    try:
-        await asyncio.wait_for(speech_semaphore.acquire(), timeout=0.01)
-    except asyncio.TimeoutError:
-        return f"Speech busy (too many concurrent requests) {format_status(engine_name=engine_name, mode=mode, speed=speed, dedupe_seconds=dedupe_seconds, hard_timeout_seconds=hard_timeout_seconds, timeout_seconds=timeout_seconds, timeout_used=None, dynamic_timeout=None)}"
-    task: asyncio.Task[str] = asyncio.create_task(_run())
+    if not await try_acquire_speech_slot():
+        return f"Speech busy (too many concurrent requests) {format_status(status)}"
 
-    def _release(_: asyncio.Task[str]) -> None:
+    async def _run_in_background() -> str:
         try:
-            speech_semaphore.release()
-        except ValueError:
-            pass
-        background_tasks.discard(task)
+            return await _run()
+        finally:
+            await release_speech_slot()
+            background_tasks.discard(asyncio.current_task())
 
-    background_tasks.add(task)
-    task.add_done_callback(_release)
-    return f"Speech started {format_status(engine_name=engine_name, mode=mode, speed=speed, dedupe_seconds=dedupe_seconds, hard_timeout_seconds=hard_timeout_seconds, timeout_seconds=timeout_seconds, timeout_used=hard_timeout_seconds, dynamic_timeout=None)}"
+    # background_tasks holds the strong reference asyncio requires for fire-and-forget
+    # tasks; each task removes itself on exit, so no done-callback is needed.
+    background_tasks.add(asyncio.create_task(_run_in_background()))
+    return f"Speech started {format_status(status)}"
 
 
 @mcp.tool()
@@ -411,6 +443,19 @@ async def stop_speech(all: bool = True) -> str:
     return f"Stopped speech ({len(keys)})."
 
 
+@mcp.tool()
+async def set_speech_concurrency(limit: int) -> str:
+    """同時に実行できる読み上げ数の上限を変更します。"""
+    global speech_limit
+    if limit < 1:
+        return "Invalid limit (must be >= 1)."
+    async with speech_cond:
+        speech_limit = limit
+        # Wake every waiter; those still over the new limit go back to waiting.
+        speech_cond.notify_all()
+    return f"Speech concurrency set to {limit}."
+
+
 def main() -> None:
     mcp.run()
 
@@ -1,41 +1,61 @@
 #!/usr/bin/env python3
+import os
 import sys
+import signal
 import subprocess
-import re
 
-DEFAULT_WPM = 175
+from agent_say.core import speed_to_wpm, strip_markdown
 
-def strip_markdown(text):
+
+def run_engine(cmd, *, detach=False):
     """
-    Remove common markdown syntax for cleaner speech.
+    Run a speech engine command.
+    With detach=True the engine is spawned in its own session and left running,
+    so this process can exit while audio plays.
     """
-    # Remove bold/italic (**text**, __text__, *text*, _text_)
-    text = re.sub(r'(\*\*|__)(.*?)\1', r'\2', text)
-    text = re.sub(r'(\*|_)(.*?)\1', r'\2', text)
-    # Remove links [text](url) -> text
-    text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
-    # Remove code `text` -> text
-    text = re.sub(r'`([^`]+)`', r'\1', text)
-    # Remove blockquotes > text
-    text = re.sub(r'^>\s?', '', text, flags=re.MULTILINE)
-    # Remove headers # text
-    text = re.sub(r'^#+\s?', '', text, flags=re.MULTILINE)
-    return text.strip()
+    if detach:
+        # posix_spawnp skips the fork and the new session outlives our exit.
+        os.posix_spawnp(cmd[0], cmd, os.environ, setsid=True)
+        return
+    proc = subprocess.Popen(cmd)
+    interrupts = 0
+
+    def on_sigint(signum, frame):
+        nonlocal interrupts
+        interrupts += 1
+        if interrupts > 1:
+            # Second Ctrl-C: the engine ignored the first one.
+            proc.kill()
+        else:
+            # Always forward: a SIGINT sent to our PID alone (e.g. by a supervisor)
+            # would not reach the engine, and a duplicate from a terminal is harmless.
+            proc.send_signal(signum)
 
-def speak_reply(text, *, speed=1.0):
+    # Keep waiting for the engine to exit on Ctrl-C, then report the interrupt.
+    previous = signal.signal(signal.SIGINT, on_sigint)
+    try:
+        returncode = proc.wait()
+    finally:
+        signal.signal(signal.SIGINT, previous)
+    if interrupts:
+        raise KeyboardInterrupt
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+def speak_reply(text, *, speed=1.0, detach=False):
     # Strip markdown for cleaner speech
     clean_text = strip_markdown(text)
-    wpm = max(80, min(600, int(round(DEFAULT_WPM * speed))))
+    wpm = speed_to_wpm(speed)
     
     try:
         # Use 'say' command directly. The agent's behavior is now corrected
         # to wait for the next user turn, so we no longer need a blocking call.
-        subprocess.run(["say", "-r", str(wpm), clean_text], check=True)
+        run_engine(["say", "-r", str(wpm), clean_text], detach=detach)
     except FileNotFoundError:
         print("Info: 'say' command not found. Falling back to 'espeak'...")
         try:
             # Fallback to espeak.
-            subprocess.run(["espeak", "-s", str(wpm), clean_text], check=True)
+            run_engine(["espeak", "-s", str(wpm), clean_text], detach=detach)
         except FileNotFoundError:
             print("Error: No suitable speech engine found (say or espeak).")
     except subprocess.CalledProcessError as e:
@@ -44,26 +64,33 @@ def speak_reply(text, *, speed=1.0):
 
 def main():
     if len(sys.argv) < 2:
-        print("Usage: python speak_cli.py [--speed <multiplier>] <text_to_speak>")
+        print("Usage: python speak_cli.py [--speed <multiplier>] [--detach] <text_to_speak>")
         sys.exit(1)
 
     args = sys.argv[1:]
     speed = 1.0
-    if len(args) >= 2 and args[0] == "--speed":
-        try:
-            speed = float(args[1])
-        except ValueError:
-            print("Error: invalid --speed value (must be a number)")
-            sys.exit(2)
-        if speed <= 0:
-            print("Error: invalid --speed value (must be positive)")
-            sys.exit(2)
-        args = args[2:]
+    detach = False
+    while args:
+        if len(args) >= 2 and args[0] == "--speed":
+            try:
+                speed = float(args[1])
+            except ValueError:
+                print("Error: invalid --speed value (must be a number)")
+                sys.exit(2)
+            if speed <= 0:
+                print("Error: invalid --speed value (must be positive)")
+                sys.exit(2)
+            args = args[2:]
+        elif args[0] == "--detach":
+            detach = True
+            args = args[1:]
+        else:
+            break
     if not args:
         print("Error: text is required")
         sys.exit(2)
     text_to_speak = " ".join(args)
-    speak_reply(text_to_speak, speed=speed)
+    speak_reply(text_to_speak, speed=speed, detach=detach)
 
 if __name__ == "__main__":
     main()